@@ -0,0 +1,79 @@
+# ble_frame.py
+# Per-notification hot path: binary frame parsing and in-order delivery to the
+# waiting request. Typed for mypyc; `python ble_frame.py --check-build` compiles
+# it and checks that the built extension module (which takes precedence over
+# this file) is what gets imported.
+import asyncio
+import struct
+import sys
+from typing import Dict, Tuple
+
+# Notification frame: magic | flags | seq | rid, followed by raw payload bytes.
+# Frames without the magic prefix are treated as the legacy JSON envelope.
+FRAME_MAGIC = b"BP"
+FLAG_FINAL = 0x01
+HDR = struct.Struct("<2sBHI")
+REORDER_WINDOW = 8  # fragments held while waiting for a missing seq
+
+class PendingResponse:
+    # Stream state for one in-flight request. The queue yields payloads in seq
+    # order, then None at the end, or an exception if the stream is broken.
+    queue: "asyncio.Queue[object]"
+    next_seq: int
+    early: Dict[int, Tuple[bytes, bool]]
+    closed: bool
+
+    def __init__(self) -> None:
+        self.queue = asyncio.Queue()
+        self.next_seq = 0
+        self.early = {}
+        self.closed = False
+
+    def push(self, payload: bytes, final: bool) -> None:
+        if payload:
+            self.queue.put_nowait(payload)
+        if final:
+            self.queue.put_nowait(None)
+            self.closed = True
+
+    def fail(self, error: Exception) -> None:
+        self.queue.put_nowait(error)
+        self.closed = True
+
+    def push_frame(self, seq: int, payload: bytes, final: bool) -> None:
+        ahead = (seq - self.next_seq) & 0xFFFF
+        if ahead >= REORDER_WINDOW or seq in self.early:
+            self.fail(ValueError(f"Fragment {seq} lost or duplicated (expected {self.next_seq})"))
+            return
+        self.early[seq] = (payload, final)
+        while not self.closed and self.next_seq in self.early:
+            payload, final = self.early.pop(self.next_seq)
+            self.next_seq = (self.next_seq + 1) & 0xFFFF
+            self.push(payload, final)
+
+def dispatch_frame(data: bytearray, pending: Dict[int, PendingResponse]) -> bool:
+    # Routes a binary frame to its request; returns False if data is not a binary frame.
+    if data[:2] != FRAME_MAGIC:
+        return False
+    _, flags, seq, rid = HDR.unpack_from(data)
+    entry = pending.get(rid)
+    if entry is not None and not entry.closed:
+        entry.push_frame(seq, bytes(data[HDR.size:]), bool(flags & FLAG_FINAL))
+    return True
+
+def check_build() -> None:
+    import importlib
+    import os
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run(["mypyc", "ble_frame.py"], cwd=here, check=True)
+    sys.path.insert(0, here)
+    module = importlib.import_module("ble_frame")
+    if not module.__file__ or module.__file__.endswith(".py"):
+        sys.exit(f"❌ ble_frame imported from {module.__file__}, not the compiled module")
+    print(f"✅ ble_frame compiled: {module.__file__}")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--check-build"]:
+        check_build()
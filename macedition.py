@@ -1,24 +1,68 @@
 # ble_proxy_mac_only.py
+import argparse
 import asyncio
 import json
-import base64
-import time
+import itertools
+import os
+import struct
 import platform
+import signal
 from aiohttp import web
 from bleak import BleakClient, BleakScanner, BleakError
+from ble_frame import PendingResponse, dispatch_frame
+
+try:
+    import pybase64 as _b64  # SIMD codec, same API as base64
+except ImportError:
+    import base64 as _b64
+
+try:
+    import orjson
+    _json_dumps = orjson.dumps  # returns bytes
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+    _json_loads = json.loads  # accepts UTF-8 bytes directly
 
 # Ensure macOS
 if platform.system() != "Darwin":
     raise RuntimeError("❌ This script only works on macOS")
 
-BLE_CHUNK_SIZE = 120
+DEFAULT_CHUNK_SIZE = 120
+WRITE_CREDITS = 16  # writes-without-response between acknowledged writes
 SCAN_TIMEOUT = 10.0
 REQUEST_TIMEOUT = 90.0
 
+# Request/response message: META_LEN | META_JSON | BODY_LEN | BODY, lengths as u32.
+# Only the small metadata dict is JSON; the body travels as raw bytes.
+LEN_PREFIX = struct.Struct("<I")
+
+# Readiness handshake after subscribing: a one-byte ping (reserved rid 0) on the
+# command characteristic, answered by a one-byte pong notification.
+PING = b"\x00"
+PING_TIMEOUT = 1.0
+
 # ---------- Utils ----------
-def chunk_bytes(b: bytes, n=BLE_CHUNK_SIZE):
-    for i in range(0, len(b), n):
-        yield b[i:i + n]
+def chunk_bytes(b: bytes, n=DEFAULT_CHUNK_SIZE):
+    mv = memoryview(b)
+    return [mv[i:i + n] for i in range(0, len(mv), n)]
+
+def pack_message(meta, body=b""):
+    meta_bytes = _json_dumps(meta)
+    return b"".join((LEN_PREFIX.pack(len(meta_bytes)), meta_bytes, LEN_PREFIX.pack(len(body)), body))
+
+def unpack_message_head(data):
+    # Returns (meta, body_start, body_len) once the metadata has fully arrived, else None.
+    if len(data) < LEN_PREFIX.size:
+        return None
+    (meta_len,) = LEN_PREFIX.unpack_from(data)
+    body_start = LEN_PREFIX.size + meta_len + LEN_PREFIX.size
+    if len(data) < body_start:
+        return None
+    (body_len,) = LEN_PREFIX.unpack_from(data, body_start - LEN_PREFIX.size)
+    meta = _json_loads(bytes(data[LEN_PREFIX.size:LEN_PREFIX.size + meta_len]))
+    return meta, body_start, body_len
 
 # ---------- Device Selection ----------
 async def select_device():
@@ -32,133 +76,305 @@ async def select_device():
     for i, d in enumerate(devices):
         print(f"[{i}] {d.name or 'Unknown'} - {d.address}")
 
+    loop = asyncio.get_running_loop()
     try:
-        index = int(input("\nEnter the number of the device to connect: "))
+        prompt = "\nEnter the number of the device to connect: "
+        index = int(await loop.run_in_executor(None, input, prompt))
         return devices[index].address
     except (ValueError, IndexError):
         print("❌ Invalid selection.")
         return None
 
 # ---------- Connect and Detect ----------
-async def detect_characteristics(address):
-    async with BleakClient(address, timeout=30) as client:
-        if not client.is_connected:
-            raise BleakError(f"❌ Could not connect to {address}")
-
-        print("✅ Connected. Detecting characteristics...")
-        await asyncio.sleep(1)  # allow macOS stack to populate services
+async def safe_connect(address):
+    client = BleakClient(address, timeout=30, disconnected_callback=on_disconnect)
+    await client.connect()
+    if not client.is_connected:
+        raise BleakError(f"❌ Could not connect to {address}")
+    return client
 
-        services = client.services
-        if not services:
-            raise RuntimeError("❌ Could not read any BLE services from device.")
+async def detect_characteristics(client):
+    print("✅ Connected. Detecting characteristics...")
+    # connect() only returns once service discovery is done, so no settle delay is needed.
+    services = client.services
+    if not services:
+        raise RuntimeError("❌ Could not read any BLE services from device.")
 
-        possible_chars = []
+    if os.environ.get("BLE_DEBUG") == "1":
         for service in services:
+            print(f"🔧 Service {service.uuid}")
             for char in service.characteristics:
-                if "write" in char.properties or "notify" in char.properties:
-                    possible_chars.append(char.uuid)
-
-        if not possible_chars:
-            raise RuntimeError("❌ No suitable characteristics found.")
-
-        cmd_char = None
-        resp_char = None
-        for char in possible_chars:
-            props = next((c.properties for s in services for c in s.characteristics if c.uuid == char), [])
-            if "write" in props and cmd_char is None:
-                cmd_char = char
-            if "notify" in props and resp_char is None:
-                resp_char = char
-
-        if not cmd_char:
-            cmd_char = possible_chars[0]
-        if not resp_char:
-            resp_char = cmd_char
-
-        print(f"\n✨ CMD_CHAR: {cmd_char}")
-        print(f"✨ RESP_CHAR: {resp_char}")
-        return cmd_char, resp_char
+                print(f"🔧   {char.uuid}: {', '.join(char.properties)}")
 
-# ---------- Send Command ----------
-async def send_command_and_get_response(address, cmd_char, resp_char, command_bytes, timeout=REQUEST_TIMEOUT):
-    fragments = {}
-    finished = asyncio.Event()
+    possible_chars = []
+    for service in services:
+        for char in service.characteristics:
+            props = set(char.properties)
+            if "write" in props or "notify" in props:
+                possible_chars.append((char, props))
+
+    if not possible_chars:
+        raise RuntimeError("❌ No suitable characteristics found.")
+
+    cmd_char = next((c for c, p in possible_chars if "write" in p), None)
+    resp_char = next((c for c, p in possible_chars if "notify" in p), None)
+
+    if not cmd_char:
+        cmd_char = possible_chars[0][0]
+    if not resp_char:
+        resp_char = cmd_char
+
+    print(f"\n✨ CMD_CHAR: {cmd_char}")
+    print(f"✨ RESP_CHAR: {resp_char}")
+    return cmd_char, resp_char
+
+# ---------- Persistent Connection ----------
+def notif_handler(sender, data: bytearray):
+    if data[:1] == PING:
+        pong.set()
+        return
+    try:
+        if dispatch_frame(data, pending):
+            return
+        # Legacy JSON frames are taken in arrival order.
+        msg = _json_loads(data)
+        entry = pending.get(msg.get("id"))
+        if entry is None or entry.closed:
+            return
+        payload_b64 = msg.get("payload_b64", "")
+        payload = _b64.b64decode(payload_b64, validate=False) if payload_b64 else b""
+        entry.push(payload, bool(msg.get("final", False)))
+    except Exception as e:
+        print("⚠️ Notification parse error:", e)
+
+async def get_client():
+    global ble_client, ble_chunk_size, write_no_response, write_acked, ping_supported, CMD_CHAR, RESP_CHAR
+    if ble_client is not None and ble_client.is_connected:
+        return ble_client
+
+    ble_client = None
+    client = await safe_connect(connected_address)
+    try:
+        # Characteristic objects belong to this connection, so detect them anew.
+        CMD_CHAR, RESP_CHAR = await resolve_characteristics(client)
+        # CoreBluetooth negotiates the ATT MTU itself; 3 bytes go to the ATT header.
+        ble_chunk_size = max(20, client.mtu_size - 3)
+        write_no_response = "write-without-response" in CMD_CHAR.properties
+        write_acked = "write" in CMD_CHAR.properties
+        print(f"📏 MTU {client.mtu_size}, chunk size {ble_chunk_size}")
+        await client.start_notify(RESP_CHAR, notif_handler)
+        if ping_supported is not False:
+            pong.clear()
+            await client.write_gatt_char(CMD_CHAR, PING, response=not write_no_response)
+            try:
+                await asyncio.wait_for(pong.wait(), timeout=PING_TIMEOUT)
+                ping_supported = True
+            except asyncio.TimeoutError:
+                # Only a silent first connection means the firmware lacks ping;
+                # a missed pong later is treated as transient.
+                print("⚠️ No pong from device; falling back to a short settle delay.")
+                if ping_supported is None:
+                    ping_supported = False
+                await asyncio.sleep(0.1)
+        else:
+            await asyncio.sleep(0.1)
+    except Exception:
+        await client.disconnect()
+        raise
+    ble_client = client
+    return ble_client
+
+async def resolve_characteristics(client):
+    if not (cmd_uuid and resp_uuid):
+        cmd_char, resp_char = await detect_characteristics(client)
+    if cmd_uuid:
+        cmd_char = client.services.get_characteristic(cmd_uuid)
+    if resp_uuid:
+        resp_char = client.services.get_characteristic(resp_uuid)
+    if cmd_char is None or resp_char is None:
+        raise RuntimeError("❌ Configured characteristic not found on device.")
+    if cmd_uuid and not {"write", "write-without-response"} & set(cmd_char.properties):
+        raise RuntimeError(f"❌ Characteristic {cmd_uuid} is not writable.")
+    if resp_uuid and not {"notify", "indicate"} & set(resp_char.properties):
+        raise RuntimeError(f"❌ Characteristic {resp_uuid} does not support notify or indicate.")
+    return cmd_char, resp_char
 
-    def notif_handler(sender, data: bytearray):
+def fail_pending(error, keep=None):
+    for rid, entry in pending.items():
+        if rid != keep and not entry.closed:
+            entry.fail(error)
+
+def on_disconnect(client):
+    # Only an unexpected drop of the live client; drop_client() clears
+    # ble_client before disconnecting and fails the pending requests itself.
+    if client is ble_client:
+        fail_pending(BleakError("BLE connection lost"))
+
+async def drop_client(keep=None):
+    # Requests waiting on the old connection lost their subscription and the
+    # peer's state, so fail them now rather than after REQUEST_TIMEOUT.
+    global ble_client
+    client, ble_client = ble_client, None
+    fail_pending(BleakError("BLE connection lost"), keep)
+    if client is not None:
         try:
-            msg = json.loads(data.decode("utf-8"))
-            rid = msg.get("id")
-            seq = int(msg.get("seq", 0))
-            payload_b64 = msg.get("payload_b64", "")
-            final = bool(msg.get("final", False))
-            payload = base64.b64decode(payload_b64) if payload_b64 else b""
-            fragments.setdefault(rid, {})[seq] = payload
-            if final:
-                finished.set()
-        except Exception as e:
-            print("⚠️ Notification parse error:", e)
-
-    async with BleakClient(address, timeout=30) as client:
-        await client.start_notify(resp_char, notif_handler)
-        await asyncio.sleep(0.5)
-
-        for chunk in chunk_bytes(command_bytes, BLE_CHUNK_SIZE):
+            await client.disconnect()
+        except Exception:
+            pass
+
+# ---------- Send Command ----------
+async def send_command(client, cmd_char, command_bytes):
+    chunks = chunk_bytes(command_bytes, ble_chunk_size)
+    if write_no_response:
+        # Queue each group of unacknowledged writes together; when the
+        # characteristic supports it, the group's last write is acknowledged
+        # and acts as flow control before the next group.
+        for start in range(0, len(chunks), WRITE_CREDITS):
+            group = chunks[start:start + WRITE_CREDITS]
+            unacked = group[:-1] if write_acked else group
+            await asyncio.gather(*(client.write_gatt_char(cmd_char, c, response=False) for c in unacked))
+            if write_acked:
+                await client.write_gatt_char(cmd_char, group[-1], response=True)
+    else:
+        for chunk in chunks:
             await client.write_gatt_char(cmd_char, chunk, response=True)
-            await asyncio.sleep(0.02)
+    print("📨 Command sent. Waiting for response...")
+
+async def send_with_reconnect(command_bytes, rid):
+    # Only the writes are serialized; responses are routed by rid, so requests
+    # can be in flight concurrently.
+    async with ble_lock:
+        for attempt in range(2):
+            if ble_client is not None and not ble_client.is_connected:
+                await drop_client(keep=rid)
+            client = await get_client()
+            try:
+                return await send_command(client, CMD_CHAR, command_bytes)
+            except BleakError:
+                await drop_client(keep=rid)
+                if attempt:
+                    raise
 
-        print("📨 Command sent. Waiting for response...")
+async def iter_response(queue, timeout=REQUEST_TIMEOUT):
+    while True:
         try:
-            await asyncio.wait_for(finished.wait(), timeout=timeout)
+            chunk = await asyncio.wait_for(queue.get(), timeout=timeout)
         except asyncio.TimeoutError:
             raise TimeoutError("Timed out waiting for response")
-
-        rid = json.loads(command_bytes.decode("utf-8"))["id"]
-        parts = fragments.get(rid, {})
-        assembled = b"".join(parts[i] for i in sorted(parts.keys()))
-        return assembled
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            raise chunk
+        yield chunk
 
 # ---------- HTTP-to-BLE Proxy ----------
 async def handle_request(request):
     body = await request.read()
-    req_id = f"req-{int(time.time()*1000)}"
+    req_id = next(_req_counter) & 0xFFFFFFFF
 
     cmd = {
         "id": req_id,
         "method": request.method,
         "url": str(request.url),
-        "headers": dict(request.headers)
+        "headers": list(request.headers.items())
     }
-    if body:
-        cmd["body_b64"] = base64.b64encode(body).decode("ascii")
-
-    cmd_bytes = json.dumps(cmd).encode("utf-8")
+    cmd_bytes = pack_message(cmd, body)
 
-    global connected_address, CMD_CHAR, RESP_CHAR
-    if not connected_address:
-        connected_address = await select_device()
-        CMD_CHAR, RESP_CHAR = await detect_characteristics(connected_address)
+    pending[req_id] = PendingResponse()
+    try:
+        return await relay_response(request, cmd_bytes, req_id)
+    finally:
+        pending.pop(req_id, None)
 
+async def relay_response(request, cmd_bytes, req_id):
+    # The response head (status + headers) is buffered; the body is streamed
+    # to the HTTP client as notifications arrive.
+    head = bytearray()
+    parsed = None
     try:
-        resp_bytes = await send_command_and_get_response(connected_address, CMD_CHAR, RESP_CHAR, cmd_bytes)
+        await send_with_reconnect(cmd_bytes, req_id)
+        chunks = iter_response(pending[req_id].queue)
+        async for chunk in chunks:
+            head += chunk
+            try:
+                parsed = unpack_message_head(head)
+            except ValueError:
+                continue  # not a framed message; keep buffering for the legacy path
+            if parsed is not None:
+                break
+    except ValueError as e:
+        return web.Response(text=f"Corrupted response from device: {e}", status=502)
     except Exception as e:
         return web.Response(text=f"Error communicating with device: {e}", status=504)
 
+    if parsed is None:
+        return legacy_response(head)
+
+    meta, body_start, body_len = parsed
+    sent = len(head) - body_start
+    if sent > body_len:
+        return web.Response(text="Corrupted response from device: body longer than declared", status=502)
+
+    resp = web.StreamResponse(status=int(meta.get("status", 200)), headers=meta.get("headers", {}))
+    resp.content_length = body_len
+    await resp.prepare(request)
     try:
-        msg = json.loads(resp_bytes.decode("utf-8"))
+        if sent:
+            await resp.write(head[body_start:])
+        async for chunk in chunks:
+            sent += len(chunk)
+            if sent > body_len:
+                raise ValueError("body longer than declared")
+            await resp.write(chunk)
+        if sent != body_len:
+            raise ValueError(f"body ended after {sent} of {body_len} bytes")
+    except Exception as e:
+        # Headers are already sent; closing the connection short of
+        # Content-Length is the only way left to signal the failure.
+        print("⚠️ Aborting streamed response:", e)
+        resp.force_close()
+        return resp
+    await resp.write_eof()
+    return resp
+
+def legacy_response(resp_bytes):
+    # Legacy peers answer with a single JSON object and a base64 body.
+    try:
+        msg = _json_loads(resp_bytes)
         status = int(msg.get("status", 200))
         headers = msg.get("headers", {})
         body_b64 = msg.get("body_b64", "")
-        body = base64.b64decode(body_b64) if body_b64 else b""
+        body = _b64.b64decode(body_b64, validate=False) if body_b64 else b""
         return web.Response(body=body, status=status, headers=headers)
     except Exception:
         return web.Response(body=resp_bytes, status=200)
 
 # ---------- Entry Point ----------
 connected_address = None
+cmd_uuid = None
+resp_uuid = None
 CMD_CHAR = None
 RESP_CHAR = None
+ble_client = None
+ble_chunk_size = DEFAULT_CHUNK_SIZE
+write_no_response = False
+write_acked = True
+ping_supported = None  # unknown until the first connection answers (or not)
+ble_lock = None  # created in main(); asyncio primitives bind to the running loop on 3.8/3.9
+pending = {}
+_req_counter = itertools.count(1)
+pong = None  # created in main(), like ble_lock
+
+async def main(args):
+    global connected_address, cmd_uuid, resp_uuid, ble_lock, pong
+    ble_lock = asyncio.Lock()
+    pong = asyncio.Event()
+    cmd_uuid, resp_uuid = args.cmd_char, args.resp_char
+    # Pick the device before serving so no request waits on the scan or prompt.
+    connected_address = args.address or await select_device()
+    if not connected_address:
+        return
 
-async def main():
     app = web.Application()
     app.router.add_route('*', '/{tail:.*}', handle_request)
     runner = web.AppRunner(app)
@@ -166,8 +382,23 @@ async def main():
     site = web.TCPSite(runner, '127.0.0.1', 8080)
     print("\n🚀 Proxy listening on http://127.0.0.1:8080")
     await site.start()
-    while True:
-        await asyncio.sleep(3600)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    await stop.wait()
+
+    print("\n👋 Shutting down...")
+    await runner.cleanup()
+    await drop_client()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="HTTP-to-BLE proxy (macOS)")
+    parser.add_argument("--address", help="device address; skips the interactive scan")
+    parser.add_argument("--cmd-char", help="command characteristic UUID; skips auto-detection")
+    parser.add_argument("--resp-char", help="response characteristic UUID; skips auto-detection")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))